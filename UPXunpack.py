@@ -4,20 +4,104 @@ UPX Unpacker Script
 Automated tool for unpacking UPX-compressed executables
 """
 
+import functools
 import os
+import re
 import sys
-import subprocess
 import shutil
-from pathlib import Path
-import hashlib
+
+# asyncio, subprocess and hashlib are imported where they are used so that
+# --help and signature checks do not pay for them at startup
+
+# Files below this size are unpacked several per UPX invocation, where
+# process startup dominates the actual decompression
+_BATCH_FILE_SIZE = 1 << 20
+_BATCH_SIZE = 256
+
+# Stay below the 32767-character command line limit on Windows
+_MAX_CMDLINE = 32000
+
+# Read size for hashing; small reads are dominated by per-call overhead
+_HASH_CHUNK_SIZE = 1 << 20
+
+# UPX signatures, compiled into one alternation so the header is scanned in
+# a single pass however many signatures are listed
+_UPX_SIGNATURES = (
+    b'UPX!',
+    b'UPX0',
+    b'UPX1',
+    b'UPX2',
+    b'UPX ',
+    b'$Id: UPX',
+)
+_UPX_SIG_RE = re.compile(b'|'.join(re.escape(sig) for sig in _UPX_SIGNATURES))
+
+@functools.lru_cache(maxsize=4096)
+def _scan_upx_signature(file_path, mtime_ns, size):
+    """Scan the file header for UPX signatures (mtime_ns/size key the cache)"""
+    # Raw descriptor read skips building a buffered file object;
+    # os.read on a fresh descriptor reads from offset 0 like
+    # os.pread, which is not available on Windows. A single 4KB read
+    # costs the same as a smaller one since the kernel reads whole pages.
+    fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        data = os.read(fd, 4096)  # Read first 4KB
+    finally:
+        os.close(fd)
+
+    # Check for UPX signatures
+    return _UPX_SIG_RE.search(data) is not None
+
+def _copy_file(src, dst):
+    """Copy src to dst, letting the kernel clone or copy the data on Linux"""
+    if sys.platform.startswith('linux'):
+        try:
+            fd_in = os.open(src, os.O_RDONLY)
+            try:
+                fd_out = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+                try:
+                    import fcntl
+
+                    # Reflink (FICLONE) shares the blocks on btrfs/XFS;
+                    # otherwise copy_file_range copies inside the kernel
+                    try:
+                        fcntl.ioctl(fd_out, getattr(fcntl, 'FICLONE', 0x40049409), fd_in)
+                        return
+                    except OSError:
+                        pass
+
+                    size = os.fstat(fd_in).st_size
+                    offset = 0
+                    while offset < size:
+                        copied = os.copy_file_range(fd_in, fd_out, size - offset, offset, offset)
+                        if not copied:
+                            break
+                        offset += copied
+
+                    # Some file systems report 0 before the end; fall back
+                    # to a regular copy rather than keep a truncated one
+                    if offset >= size:
+                        return
+                finally:
+                    os.close(fd_out)
+            finally:
+                os.close(fd_in)
+        except (AttributeError, OSError):
+            # Old kernel/Python or unsupported file system
+            pass
+
+    shutil.copyfile(src, dst)
 
 class UPXUnpacker:
     def __init__(self):
         self.upx_path = self.find_upx()
         self.verbose = False
+        self.max_workers = os.cpu_count() or 1
 
-    def find_upx(self):
-        """Find UPX executable in system PATH or common locations"""
+    @classmethod
+    @functools.lru_cache(maxsize=1)
+    def find_upx(cls):
+        """Find UPX executable in system PATH or common locations (cached per process)"""
         # Check if upx is in PATH
         if shutil.which('upx'):
             return 'upx'
@@ -41,139 +125,425 @@ class UPXUnpacker:
     def is_upx_packed(self, file_path):
         """Check if a file is UPX-packed by examining headers"""
         try:
-            with open(file_path, 'rb') as f:
-                data = f.read(4096)  # Read first 4KB
-
-                # Check for UPX signatures
-                upx_signatures = [
-                    b'UPX!',
-                    b'UPX0',
-                    b'UPX1',
-                    b'UPX2',
-                    b'UPX ',
-                    b'$Id: UPX',
-                    b'\x55\x50\x58\x21'  # UPX! in hex
-                ]
-
-                for sig in upx_signatures:
-                    if sig in data:
-                        return True
-
-                return False
+            # Cached per path; mtime and size invalidate the entry when the
+            # file changes
+            st = os.stat(file_path)
+            return _scan_upx_signature(os.fspath(file_path), st.st_mtime_ns, st.st_size)
         except Exception as e:
             print(f"Error checking UPX signature: {e}")
             return False
 
     def get_file_hash(self, file_path):
         """Calculate SHA-256 hash of file"""
-        hash_sha256 = hashlib.sha256()
+        import hashlib
+
         try:
             with open(file_path, 'rb') as f:
-                for chunk in iter(lambda: f.read(4096), b""):
+                # Python 3.11+ hashes the whole file in C with the GIL released
+                if hasattr(hashlib, 'file_digest'):
+                    return hashlib.file_digest(f, 'sha256').hexdigest()
+
+                hash_sha256 = hashlib.sha256()
+                for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
                     hash_sha256.update(chunk)
             return hash_sha256.hexdigest()
         except:
             return None
 
-    def unpack_file(self, input_file, output_file=None, force=False):
-        """Unpack a single UPX-compressed file"""
+    def _default_output(self, input_file):
+        """Build the default <name>_unpacked<ext> output path"""
+        root, ext = os.path.splitext(input_file)
+        return f"{root}_unpacked{ext}"
+
+    def _prepare_output(self, input_file, output_file=None, force=False, skip_check=False):
+        """Validate input_file and clear its output path, returning (failure, output_file)"""
         if not self.upx_path:
-            return False, "UPX executable not found. Please install UPX or specify path."
+            return (False, "UPX executable not found. Please install UPX or specify path."), None
 
         if not os.path.exists(input_file):
-            return False, f"Input file not found: {input_file}"
+            return (False, f"Input file not found: {input_file}"), None
 
-        # Check if file is UPX-packed
-        if not force and not self.is_upx_packed(input_file):
-            return False, f"File does not appear to be UPX-packed: {input_file}"
+        # Check if file is UPX-packed (skip_check: caller already did)
+        if not force and not skip_check and not self.is_upx_packed(input_file):
+            return (False, f"File does not appear to be UPX-packed: {input_file}"), None
 
         # Determine output file name
         if output_file is None:
-            input_path = Path(input_file)
-            output_file = str(input_path.with_name(f"{input_path.stem}_unpacked{input_path.suffix}"))
+            output_file = self._default_output(input_file)
 
-        # Copy input file to output location for unpacking
+        # UPX refuses to overwrite an existing output file, so clear any
+        # stale output first
         try:
-            shutil.copy2(input_file, output_file)
+            if os.path.exists(output_file):
+                if os.path.samefile(input_file, output_file):
+                    return (False, f"Output file must differ from input file: {output_file}"), None
+                os.remove(output_file)
         except Exception as e:
-            return False, f"Failed to copy file: {e}"
+            return (False, f"Failed to remove existing output file: {e}"), None
+
+        return None, output_file
+
+    def _verify_output(self, output_file, original_size, error_msg=None):
+        """Check the result of unpacking to output_file, removing it on failure"""
+        if error_msg is None:
+            # Verify unpacking was successful - an unpacked file is always
+            # larger than its packed form, so a size check is enough
+            if os.path.getsize(output_file) != original_size:
+                return True, f"Successfully unpacked to: {output_file}"
+
+        # Clean up failed output file
+        if os.path.exists(output_file):
+            os.remove(output_file)
+
+        if error_msg is None:
+            return False, "File unchanged - may not have been UPX packed"
+        return False, f"UPX unpacking failed: {error_msg}"
+
+    def unpack_file(self, input_file, output_file=None, force=False, skip_check=False):
+        """Unpack a single UPX-compressed file"""
+        import subprocess
 
-        # Get original file hash
-        original_hash = self.get_file_hash(input_file)
+        failure, output_file = self._prepare_output(input_file, output_file, force, skip_check)
+        if failure:
+            return failure
 
-        # Run UPX unpacker
+        # Run UPX unpacker, letting it write the output file itself (-o)
         try:
-            cmd = [self.upx_path, '-d', output_file]
+            # Get original file size
+            original_size = os.path.getsize(input_file)
+
+            cmd = [self.upx_path, '-d', '-o', output_file, input_file]
 
             if self.verbose:
-                print(f"Running command: {' '.join(cmd)}")
+                print(f"Running command: {' '.join(map(str, cmd))}")
 
+            # UPX's progress output is only kept in verbose mode; stderr is
+            # kept raw and only decoded when reporting a failure
             result = subprocess.run(
                 cmd,
-                capture_output=True,
-                text=True,
+                stdout=subprocess.PIPE if self.verbose else subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
                 timeout=300  # 5 minute timeout
             )
 
-            if result.returncode == 0:
-                # Verify unpacking was successful
-                unpacked_hash = self.get_file_hash(output_file)
-
-                if unpacked_hash == original_hash:
-                    return False, "File unchanged - may not have been UPX packed"
+            if self.verbose and result.stdout:
+                print(result.stdout.decode(errors='replace').rstrip())
 
-                return True, f"Successfully unpacked to: {output_file}"
-            else:
-                # Clean up failed output file
-                if os.path.exists(output_file):
-                    os.remove(output_file)
+            error_msg = None
+            if result.returncode != 0:
+                error_msg = result.stderr.decode(errors='replace').strip() or "Unknown error"
 
-                error_msg = result.stderr.strip() if result.stderr else "Unknown error"
-                return False, f"UPX unpacking failed: {error_msg}"
+            return self._verify_output(output_file, original_size, error_msg)
 
         except subprocess.TimeoutExpired:
+            # Clean up partial output file
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            return False, "UPX unpacking timed out"
+        except Exception as e:
+            return False, f"Error running UPX: {e}"
+
+    async def _run_upx_async(self, cmd):
+        """Run UPX without blocking the event loop, returning (returncode, raw stderr)"""
+        import asyncio
+
+        if self.verbose:
+            print(f"Running command: {' '.join(map(str, cmd))}")
+
+        # UPX's progress output is only kept in verbose mode
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE if self.verbose else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=300)  # 5 minute timeout
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # UPX may already have exited; keep the original exception
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+            raise
+
+        if self.verbose and stdout:
+            print(stdout.decode(errors='replace').rstrip())
+
+        return proc.returncode, stderr
+
+    async def _unpack_file_async(self, input_file):
+        """Unpack a single UPX-compressed file on the event loop"""
+        import asyncio
+
+        failure, output_file = self._prepare_output(input_file)
+        if failure:
+            return failure
+
+        try:
+            # Get original file size
+            original_size = os.path.getsize(input_file)
+
+            returncode, stderr = await self._run_upx_async(
+                [self.upx_path, '-d', '-o', output_file, input_file])
+
+            error_msg = None
+            if returncode != 0:
+                error_msg = stderr.decode(errors='replace').strip() or "Unknown error"
+
+            return self._verify_output(output_file, original_size, error_msg)
+
+        except asyncio.TimeoutError:
+            # Clean up partial output file
+            if os.path.exists(output_file):
+                os.remove(output_file)
             return False, "UPX unpacking timed out"
+        except asyncio.CancelledError:
+            # Do not leave a partial output behind
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            raise
         except Exception as e:
             return False, f"Error running UPX: {e}"
 
+    async def _unpack_batch(self, files):
+        """Unpack several files with a single UPX invocation"""
+        import asyncio
+        import tempfile
+
+        if len(files) == 1:
+            return [await self._unpack_file_async(files[0])]
+
+        outcomes = [None] * len(files)
+        staged = []  # (index, output_file, temp_file, original_size)
+
+        # UPX only accepts -o for a single file, so stage copies under
+        # temporary names next to the outputs and unpack them in place.
+        # Only verified results are renamed to their output paths.
+        for index, input_file in enumerate(files):
+            failure, output_file = self._prepare_output(input_file)
+            if failure:
+                outcomes[index] = failure
+                continue
+
+            temp_file = None
+            try:
+                original_size = os.path.getsize(input_file)
+                fd, temp_file = tempfile.mkstemp(suffix=os.path.splitext(output_file)[1],
+                                                 dir=os.path.dirname(output_file) or os.curdir)
+                os.close(fd)
+                _copy_file(input_file, temp_file)
+                shutil.copymode(input_file, temp_file)
+            except Exception as e:
+                if temp_file and os.path.exists(temp_file):
+                    os.remove(temp_file)
+                outcomes[index] = (False, f"Failed to copy file: {e}")
+                continue
+
+            staged.append((index, output_file, temp_file, original_size))
+
+        if not staged:
+            return outcomes
+
+        # Run UPX unpacker over the whole batch
+        error_msg = None
+        try:
+            returncode, stderr = await self._run_upx_async(
+                [self.upx_path, '-d'] + [temp_file for _, _, temp_file, _ in staged])
+        except asyncio.TimeoutError:
+            # The timeout is per UPX process, so one slow or hung sample
+            # would fail the whole group; retry each file on its own run
+            for index, _, temp_file, _ in staged:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                outcomes[index] = await self._unpack_file_async(files[index])
+            return outcomes
+        except asyncio.CancelledError:
+            # Do not leave staged copies behind
+            for _, _, temp_file, _ in staged:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+            raise
+        except Exception as e:
+            error_msg = f"Error running UPX: {e}"
+
+        if error_msg:
+            for index, _, temp_file, _ in staged:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                outcomes[index] = (False, error_msg)
+            return outcomes
+
+        # UPX reports per-file failures on stderr as "upx: <file>: <error>"
+        stderr_lines = stderr.decode(errors='replace').splitlines() if stderr else []
+
+        for index, output_file, temp_file, original_size in staged:
+            prefix = f"upx: {temp_file}: "
+            file_errors = [line[len(prefix):].strip() for line in stderr_lines
+                           if line.startswith(prefix)]
+
+            try:
+                success, message = self._verify_output(temp_file, original_size,
+                                                       '; '.join(file_errors) or None)
+                if success:
+                    os.replace(temp_file, output_file)
+                    message = f"Successfully unpacked to: {output_file}"
+                outcomes[index] = (success, message)
+            except Exception as e:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                outcomes[index] = (False, f"Error running UPX: {e}")
+
+        return outcomes
+
+    async def _unpack_jobs(self, jobs):
+        """Run unpack jobs concurrently, yielding (files, outcomes) as each finishes"""
+        import asyncio
+
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def run_job(files):
+            async with semaphore:
+                return files, await self._unpack_batch(files)
+
+        tasks = [asyncio.ensure_future(run_job(files)) for files in jobs]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # Stop outstanding jobs if the consumer stops early
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
     def unpack_directory(self, directory, recursive=False, extensions=None):
         """Unpack all UPX files in a directory"""
         if extensions is None:
             extensions = ['.exe', '.dll', '.sys', '.bin']
 
-        results = []
-
-        if recursive:
-            pattern = '**/*'
-        else:
-            pattern = '*'
-
-        for file_path in Path(directory).glob(pattern):
-            if file_path.is_file():
-                # Check file extension
-                if file_path.suffix.lower() in extensions:
-                    success, message = self.unpack_file(str(file_path))
-                    results.append({
-                        'file': str(file_path),
-                        'success': success,
-                        'message': message
-                    })
-
-        return results
+        # Lowercase once and use a set for O(1) extension lookups
+        extensions = frozenset(ext.lower() for ext in extensions)
+
+        # Collect candidates first so they can be unpacked in parallel
+        file_list = list(self._iter_candidates(directory, recursive, extensions))
+
+        yield from self.batch_unpack(file_list)
+
+    def _iter_candidates(self, directory, recursive, extensions):
+        """Yield paths of files in directory whose extension is in extensions"""
+        # os.scandir reports the entry type without an extra stat() and
+        # avoids building a Path object for every entry
+        stack = [directory]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except OSError:
+                # Skip unreadable directories, as Path.glob did
+                continue
+
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            stack.append(entry.path)
+                    elif entry.is_file():
+                        # Check file extension
+                        if os.path.splitext(entry.name)[1].lower() in extensions:
+                            yield entry.path
 
     def batch_unpack(self, file_list):
-        """Unpack multiple files from a list"""
-        results = []
+        """Unpack multiple files from a list, yielding results as they finish"""
+        import asyncio
+
+        file_list = list(file_list)
 
+        # A file that is another file's output gets overwritten while the
+        # jobs run, so report it instead of unpacking it
+        outputs = {}
         for file_path in file_list:
-            success, message = self.unpack_file(file_path)
-            results.append({
-                'file': file_path,
-                'success': success,
-                'message': message
-            })
+            outputs[os.path.normcase(os.path.abspath(self._default_output(file_path)))] = file_path
 
-        return results
+        # Small files are grouped so one UPX process handles several of
+        # them; larger files get their own process
+        small, jobs = [], []
+        for file_path in file_list:
+            source = outputs.get(os.path.normcase(os.path.abspath(file_path)))
+            if source is not None:
+                yield {
+                    'file': file_path,
+                    'success': False,
+                    'message': f"Skipped - output file of {source}"
+                }
+                continue
+
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                size = None
+
+            if size is not None and size < _BATCH_FILE_SIZE:
+                small.append(file_path)
+            else:
+                jobs.append([file_path])
+
+        # Give each worker one UPX process over its share of the small
+        # files, splitting further to bound the command line length
+        per_worker = min(_BATCH_SIZE, -(-len(small) // self.max_workers))
+        chunk, chunk_len = [], len(self.upx_path or '') + 3
+        for file_path in small:
+            # Staged copies get absolute mkstemp names next to the output
+            # ("tmp" plus 8 random characters and the extension), plus
+            # quoting and separator
+            output_dir, output_name = os.path.split(self._default_output(file_path))
+            arg_len = (len(os.path.abspath(output_dir or os.curdir)) + len(os.sep)
+                       + len('tmp') + 8 + len(os.path.splitext(output_name)[1]) + 3)
+            if chunk and (len(chunk) >= per_worker or chunk_len + arg_len > _MAX_CMDLINE):
+                jobs.append(chunk)
+                chunk, chunk_len = [], len(self.upx_path or '') + 3
+            chunk.append(file_path)
+            chunk_len += arg_len
+
+        if chunk:
+            jobs.append(chunk)
+
+        # Each UPX run is an independent process, so overlap them on an
+        # event loop rather than parking a thread on each one. The loop is
+        # driven one finished job at a time so results stream out.
+        loop = asyncio.new_event_loop()
+        job_results = self._unpack_jobs(jobs)
+
+        async def next_job():
+            return await job_results.__anext__()
+
+        next_task = None
+        try:
+            while True:
+                # Keep a handle on the pending step so an interrupted run
+                # (e.g. Ctrl-C) can be cancelled and cleaned up below
+                next_task = loop.create_task(next_job())
+                try:
+                    files, outcomes = loop.run_until_complete(next_task)
+                except StopAsyncIteration:
+                    break
+
+                for file_path, (success, message) in zip(files, outcomes):
+                    yield {
+                        'file': file_path,
+                        'success': success,
+                        'message': message
+                    }
+        finally:
+            # Cancelling the pending step runs the job generator's cleanup
+            # (killing UPX and removing staged copies) before it is closed
+            if next_task is not None and not next_task.done():
+                next_task.cancel()
+                try:
+                    loop.run_until_complete(next_task)
+                except (Exception, asyncio.CancelledError):
+                    pass
+            loop.run_until_complete(job_results.aclose())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
 
 def main():
     import argparse
@@ -225,17 +595,20 @@ def main():
         print(f"Processing directory: {args.input}")
         print(f"Extensions: {', '.join(extensions)}")
 
-        results = unpacker.unpack_directory(args.input, args.recursive, extensions)
-
-        success_count = sum(1 for r in results if r['success'])
-        total_count = len(results)
+        # Print each result as soon as its file is done
+        success_count = 0
+        total_count = 0
 
-        print(f"\nResults: {success_count}/{total_count} files successfully unpacked")
+        for result in unpacker.unpack_directory(args.input, args.recursive, extensions):
+            total_count += 1
+            if result['success']:
+                success_count += 1
 
-        for result in results:
             status = "SUCCESS" if result['success'] else "FAILED"
             print(f"[{status}] {result['file']}: {result['message']}")
 
+        print(f"\nResults: {success_count}/{total_count} files successfully unpacked")
+
     else:
         # Single file mode
         if not os.path.exists(args.input):
@@ -245,12 +618,14 @@ def main():
         print(f"Processing file: {args.input}")
 
         # Check if file appears to be UPX packed
-        if unpacker.is_upx_packed(args.input):
+        packed = unpacker.is_upx_packed(args.input)
+        if packed:
             print("UPX signature detected")
         elif not args.force:
             print("WARNING: UPX signature not detected. Use --force to unpack anyway.")
 
-        success, message = unpacker.unpack_file(args.input, args.output, args.force)
+        success, message = unpacker.unpack_file(args.input, args.output, args.force,
+                                                skip_check=packed)
 
         if success:
             print(f"SUCCESS: {message}")